@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
-from typing import Tuple, Any, Dict, Optional, List, FrozenSet, Union, Type, Callable
+from typing import Tuple, Any, Dict, Optional, List, FrozenSet, Union, Type, Callable, Iterator, TYPE_CHECKING
 
+if TYPE_CHECKING:
+    import requests
+
+import io
 import json
 import sys
 import zlib
@@ -10,16 +14,17 @@ import os
 import argparse
 import codecs
 import hashlib
+import functools
 
 from os.path import splitext
-from datetime import date, datetime, timedelta, timezone
+from datetime import date, datetime, timezone
 from base64 import b64decode, b64encode, urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import cbor2 # type: ignore
 import cose.algorithms # type: ignore
 import cose.keys.curves # type: ignore
 import cose.keys.keytype # type: ignore
-import requests
 import http.client
 
 from lxml.html import fromstring as parse_html # type: ignore
@@ -45,31 +50,37 @@ from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat,
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePublicKey, EllipticCurvePublicNumbers, ECDSA, SECP256R1, EllipticCurve
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey, RSAPublicNumbers
-from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature, Prehashed
 from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
-from pyzbar.pyzbar import decode as decode_qrcode # type: ignore
-from PIL import Image # type: ignore
 
 # based on: https://github.com/ehn-digital-green-development/ehn-sign-verify-python-trivial
 
 # Digital Green Certificate Gateway API SPEC: https://eu-digital-green-certificates.github.io/dgc-gateway/#/Trust%20Lists/downloadTrustList
 # But where is it hosted?
 
-EPOCH = datetime(1970, 1, 1)
-
 CertList = Dict[bytes, x509.Certificate]
 
 JS_CERT_PATTERN = re.compile(r"'({[^-']*-----BEGIN[^']*)'")
 ESC = re.compile(r'\\x([0-9a-fA-F][0-9a-fA-F])')
-CURVE_NAME_IGNORE = re.compile(r'[-_ ]')
+CURVE_NAME_IGNORE = str.maketrans('', '', '-_ ')
 
 # https://tools.ietf.org/search/rfc4492#appendix-A
-COSE_CURVES: Dict[str, Type[CoseCurve]] = {
-    'secp256r1':  P256,
-    'prime256v1': P256,
-    'secp384r1':  P384,
-    'secp521r1':  P521,
-}
+@functools.cache
+def cose_curves() -> Dict[str, Type[CoseCurve]]:
+    curves: Dict[str, Type[CoseCurve]] = {
+        'secp256r1':  P256,
+        'prime256v1': P256,
+        'secp384r1':  P384,
+        'secp521r1':  P521,
+    }
+
+    for name in dir(cose.keys.curves):
+        if not name.startswith('_'):
+            curve = getattr(cose.keys.curves, name)
+            if curve is not CoseCurve and isinstance(curve, type) and issubclass(curve, CoseCurve) and curve.fullname != 'RESERVED': # type: ignore
+                curves[curve.fullname.translate(CURVE_NAME_IGNORE).lower()] = curve # type: ignore
+
+    return curves
 
 NIST_CURVES: Dict[str, Type[EllipticCurve]] = {
     'K-163': ec.SECT163K1,
@@ -101,14 +112,6 @@ NAME_OIDS_UK = dict(
 )
 NAME_OIDS_UK.update(NAME_OIDS)
 
-for name in dir(cose.keys.curves):
-    if not name.startswith('_'):
-        curve = getattr(cose.keys.curves, name)
-        if curve is not CoseCurve and isinstance(curve, type) and issubclass(curve, CoseCurve) and curve.fullname != 'RESERVED': # type: ignore
-            name = CURVE_NAME_IGNORE.sub('', curve.fullname).lower() # type: ignore
-            COSE_CURVES[name] = curve
-del name, curve
-
 PREFIX = 'HC1:'
 PREFIX_NO = 'NO1:' # Norway
 
@@ -165,6 +168,8 @@ UPDATE_URL_CH    = 'https://www.cc.bit.admin.ch/trust/v1/keys/updates?certFormat
 
 USER_AGENT = 'Mozilla/5.0 (Windows) Firefox/90.0'
 
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'verify-ehc')
+
 # See also this thread:
 # https://github.com/eu-digital-green-certificates/dgc-participating-countries/issues/10
 
@@ -273,18 +278,71 @@ def load_ehc_certs(filename: str) -> CertList:
         certs_cbor = stream.read()
     return load_ehc_certs_cbor(certs_cbor)
 
-def load_ehc_certs_cbor(cbor_data: bytes) -> CertList:
-    certs_data = cbor2.loads(cbor_data)
-    certs: CertList = {}
-    for item in certs_data['c']:
-        key_id = item['i']
-        cert_data = item['c']
-        cert = load_der_x509_certificate(cert_data)
-        fingerprint = cert.fingerprint(hashes.SHA256())
-        if key_id != fingerprint[0:8]:
-            raise ValueError(f'Key ID missmatch: {key_id.hex()} != {fingerprint[0:8].hex()}')
+def sha256_first8(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()[:8]
+
+def read_cbor_length(stream: io.BytesIO, subtype: int) -> Optional[int]:
+    # https://tools.ietf.org/html/rfc7049#section-2
+    if subtype < 24:
+        return subtype
+    if subtype == 24:
+        return stream.read(1)[0]
+    if subtype == 25:
+        return int.from_bytes(stream.read(2), byteorder='big')
+    if subtype == 26:
+        return int.from_bytes(stream.read(4), byteorder='big')
+    if subtype == 27:
+        return int.from_bytes(stream.read(8), byteorder='big')
+    return None # indefinite length or reserved
+
+def iter_ehc_cert_items(cbor_data: bytes) -> Iterator[Any]:
+    """Stream the items of the 'c' array of a CBOR trust list one at a time
+    instead of materializing the whole outer structure in memory at once.
+    Falls back to plain cbor2.loads() for anything but the expected
+    definite-length {'c': [...]} layout."""
+    stream = io.BytesIO(cbor_data)
+    decoder = cbor2.CBORDecoder(stream)
+
+    head = stream.read(1)[0]
+    map_len = read_cbor_length(stream, head & 0x1f) if head >> 5 == 5 else None
+    if map_len is None:
+        yield from cbor2.loads(cbor_data)['c']
+        return
+
+    for _ in range(map_len):
+        key = decoder.decode()
+        if key != 'c':
+            decoder.decode() # skip irrelevant entry
+            continue
 
-        certs[key_id] = cert
+        pos = stream.tell()
+        head = stream.read(1)[0]
+        array_len = read_cbor_length(stream, head & 0x1f) if head >> 5 == 4 else None
+        if array_len is None:
+            stream.seek(pos)
+            yield from decoder.decode()
+        else:
+            for _ in range(array_len):
+                yield decoder.decode()
+        return
+
+    raise KeyError('c')
+
+def load_ehc_certs_cbor(cbor_data: bytes, into: Optional[CertList] = None) -> CertList:
+    certs: CertList = into if into is not None else {}
+    items = [(item['i'], item['c']) for item in iter_ehc_cert_items(cbor_data)]
+
+    # hashing the DER blobs dominates trust list loading, but is trivially
+    # parallel, so fingerprint everything up-front on all cores and only
+    # parse the certificates that actually check out
+    with ProcessPoolExecutor() as executor:
+        fingerprints = list(executor.map(sha256_first8, (cert_data for _, cert_data in items), chunksize=32))
+
+    for (key_id, cert_data), fingerprint in zip(items, fingerprints):
+        if key_id != fingerprint:
+            raise ValueError(f'Key ID missmatch: {key_id.hex()} != {fingerprint.hex()}')
+
+        certs[key_id] = load_der_x509_certificate(cert_data)
 
     return certs
 
@@ -354,95 +412,170 @@ def print_err(msg: str) -> None:
     sys.stdout.flush()
     print(f'ERROR: {msg}', file=sys.stderr)
 
-def load_de_trust_list(data: bytes, pubkey: Optional[EllipticCurvePublicKey] = None) -> CertList:
-    certs: CertList = {}
+def load_de_trust_list(data: bytes, pubkey: Optional[EllipticCurvePublicKey] = None, into: Optional[CertList] = None) -> CertList:
+    certs: CertList = into if into is not None else {}
 
     sign_b64, body_json = data.split(b'\n', 1)
     sign = b64decode(sign_b64)
     body = json.loads(body_json)
 
     if pubkey is not None:
-        r = int.from_bytes(sign[:len(sign)//2], byteorder="big", signed=False)
-        s = int.from_bytes(sign[len(sign)//2:], byteorder="big", signed=False)
+        half = len(sign) // 2
+        r = int.from_bytes(sign[:half], byteorder="big", signed=False)
+        s = int.from_bytes(sign[half:], byteorder="big", signed=False)
 
         sign_dds = encode_dss_signature(r, s)
 
+        # hash the (large) body once up-front and verify against the digest,
+        # so the verify call doesn't have to stream-hash it again
+        digest = hashes.Hash(hashes.SHA256())
+        digest.update(body_json)
+
         try:
-            pubkey.verify(sign_dds, body_json, ECDSA(hashes.SHA256()))
+            pubkey.verify(sign_dds, digest.finalize(), ECDSA(Prehashed(hashes.SHA256())))
         except InvalidSignature:
             raise ValueError(f'Invalid signature of DE trust list: {sign.hex()}')
 
-    for cert in body['certificates']:
-        key_id_b64 = cert['kid']
+    entries: List[Tuple[bytes, str, bytes]] = []
+    for entry in body['certificates']:
+        key_id_b64 = entry['kid']
         key_id     = b64decode(key_id_b64)
-        country    = cert['country']
-        cert_type  = cert['certificateType']
+        country    = entry['country']
+        cert_type  = entry['certificateType']
         if cert_type != 'DSC':
             print_err(f'decoding DE trust list entry {key_id.hex()} / {key_id_b64}: unknown certificateType {cert_type!r} (country={country}, kid={key_id.hex()}')
             continue
 
-        raw_data = b64decode(cert['rawData'])
+        entries.append((key_id, key_id_b64, b64decode(entry['rawData'])))
+
+    # see load_ehc_certs_cbor(): fingerprint all DER blobs in parallel first,
+    # only parse certificates whose key ID checks out
+    with ProcessPoolExecutor() as executor:
+        fingerprints = list(executor.map(sha256_first8, (raw_data for _, _, raw_data in entries), chunksize=32))
+
+    for (key_id, key_id_b64, raw_data), fingerprint in zip(entries, fingerprints):
+        if key_id != fingerprint:
+            raise ValueError(f'Key ID missmatch: {key_id.hex()} != {fingerprint.hex()}')
 
         try:
             cert = load_der_x509_certificate(raw_data)
         except Exception as error:
             print_err(f'decoding DE trust list entry {key_id.hex()} / {key_id_b64}: {error}')
         else:
-            fingerprint = cert.fingerprint(hashes.SHA256())
-            if key_id != fingerprint[0:8]:
-                raise ValueError(f'Key ID missmatch: {key_id.hex()} != {fingerprint[0:8].hex()}')
-
             certs[key_id] = cert
 
     return certs
 
-def download_at_certs() -> CertList:
-    response = requests.get(CERTS_URL_AT, headers={'User-Agent': USER_AGENT})
-    response.raise_for_status()
-    certs_json = json.loads(response.content)['trustList']
-    certs_cbor = b64decode(certs_json['trustListContent'])
-    certs_sig  = b64decode(certs_json['trustListSignature'])
-
-    sig_msg = CoseMessage.decode(certs_sig)
-    if not isinstance(sig_msg, Sign1Message):
-        raise TypeError(f'AT trust list: expected signature to be a Sign1 COSE message')
-
-    root_cert_key_id = sig_msg.phdr.get(KID) or sig_msg.uhdr[KID]
+def http_get_cached(url: str, headers: Dict[str, str], session: Optional['requests.Session'] = None) -> Tuple[int, bytes]:
+    """HTTP GET with an on-disk cache in ~/.cache/verify-ehc using
+    If-None-Match/If-Modified-Since, so unchanged trust lists are not
+    re-downloaded on every invocation. Returns (status_code, body), where a
+    304 answer is turned into a 200 with the cached body."""
+    import requests
 
-    # TODO: Find out another place where to get the AT root certificate from.
-    #       This gets it from the same server as the trust list itself, which is suboptimal.
-    # TODO: Maybe look if there is a revocation list URL in root_cert.extensions?
+    cache_name = os.path.join(CACHE_DIR, hashlib.sha256(url.encode()).hexdigest())
+    meta_path = cache_name + '.json'
+    body_path = cache_name + '.body'
 
-    response = requests.get('https://greencheck.gv.at/', headers={'User-Agent': USER_AGENT})
-    status_code = response.status_code
-    if status_code < 200 or status_code >= 300:
-        print_err(f'https://greencheck.gv.at/ {status_code} {http.client.responses.get(status_code, "")}')
+    req_headers = dict(headers)
+    cached = False
+    try:
+        with open(meta_path, 'r') as text_stream:
+            meta = json.load(text_stream)
+    except (FileNotFoundError, IsADirectoryError, ValueError):
+        pass
     else:
-        doc = parse_html(response.content.decode(response.encoding))
-
-        root_cert: Optional[x509.Certificate] = None
-        for script in doc.xpath('//script'):
-            src = script.attrib.get('src')
-            if src and src.startswith('/static/js/main.') and src.endswith('.chunk.js'):
-                response = requests.get(f'https://greencheck.gv.at{src}', headers={'User-Agent': USER_AGENT})
-                status_code = response.status_code
-                if status_code < 200 or status_code >= 300:
-                    print_err(f'https://greencheck.gv.at{src} {status_code} {http.client.responses.get(status_code, "")}')
-                else:
-                    source = response.content.decode(response.encoding)
-                    match = JS_CERT_PATTERN.search(source)
-                    if match:
-                        certs_pems_js = match.group(1)
-                        certs_pems_js = ESC.sub(lambda match: chr(int(match[1], 16)), certs_pems_js)
+        # only ask for a conditional answer if we still have the body for it
+        if os.path.exists(body_path):
+            cached = True
+            if meta.get('etag'):
+                req_headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                req_headers['If-Modified-Since'] = meta['last_modified']
+
+    get = session.get if session is not None else requests.get
+    response = get(url, headers=req_headers)
+    status_code = response.status_code
 
-                        for meta_cert_key, meta_cert_src in json.loads(certs_pems_js).items():
-                            meta_cert = load_pem_x509_certificate(meta_cert_src.encode())
+    if status_code == 304 and cached:
+        with open(body_path, 'rb') as stream:
+            return 200, stream.read()
 
-                            key_id = meta_cert.fingerprint(hashes.SHA256())[:8]
-                            if key_id == root_cert_key_id:
-                                root_cert = meta_cert
-                                break
-                    break
+    etag          = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if status_code >= 200 and status_code < 300 and (etag or last_modified):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # write through temp files and rename atomically (body first),
+            # so an interrupted or concurrent run can never leave a
+            # truncated body behind a still-matching ETag
+            tmp_path = f'{body_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as stream:
+                stream.write(response.content)
+            os.replace(tmp_path, body_path)
+
+            tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as text_stream:
+                json.dump({'url': url, 'etag': etag, 'last_modified': last_modified}, text_stream)
+            os.replace(tmp_path, meta_path)
+        except OSError as error:
+            print_err(f'caching {url}: {error}')
+
+    return status_code, response.content
+
+def download_at_certs(into: Optional[CertList] = None) -> CertList:
+    import requests
+
+    # all of these requests go to the same host, so share one session and
+    # save a TCP+TLS handshake per request
+    with requests.Session() as session:
+        status_code, content = http_get_cached(CERTS_URL_AT, {'User-Agent': USER_AGENT}, session)
+        if status_code < 200 or status_code >= 300:
+            raise ValueError(f'{CERTS_URL_AT} {status_code} {http.client.responses.get(status_code, "")}')
+        certs_json = json.loads(content)['trustList']
+        certs_cbor = b64decode(certs_json['trustListContent'])
+        certs_sig  = b64decode(certs_json['trustListSignature'])
+
+        sig_msg = CoseMessage.decode(certs_sig)
+        if not isinstance(sig_msg, Sign1Message):
+            raise TypeError(f'AT trust list: expected signature to be a Sign1 COSE message')
+
+        root_cert_key_id = sig_msg.phdr.get(KID) or sig_msg.uhdr[KID]
+
+        # TODO: Find out another place where to get the AT root certificate from.
+        #       This gets it from the same server as the trust list itself, which is suboptimal.
+        # TODO: Maybe look if there is a revocation list URL in root_cert.extensions?
+
+        response = session.get('https://greencheck.gv.at/', headers={'User-Agent': USER_AGENT})
+        status_code = response.status_code
+        if status_code < 200 or status_code >= 300:
+            print_err(f'https://greencheck.gv.at/ {status_code} {http.client.responses.get(status_code, "")}')
+        else:
+            doc = parse_html(response.content.decode(response.encoding))
+
+            root_cert: Optional[x509.Certificate] = None
+            for script in doc.xpath('//script'):
+                src = script.attrib.get('src')
+                if src and src.startswith('/static/js/main.') and src.endswith('.chunk.js'):
+                    response = session.get(f'https://greencheck.gv.at{src}', headers={'User-Agent': USER_AGENT})
+                    status_code = response.status_code
+                    if status_code < 200 or status_code >= 300:
+                        print_err(f'https://greencheck.gv.at{src} {status_code} {http.client.responses.get(status_code, "")}')
+                    else:
+                        source = response.content.decode(response.encoding)
+                        match = JS_CERT_PATTERN.search(source)
+                        if match:
+                            certs_pems_js = match.group(1)
+                            certs_pems_js = ESC.sub(lambda match: chr(int(match[1], 16)), certs_pems_js)
+
+                            for meta_cert_key, meta_cert_src in json.loads(certs_pems_js).items():
+                                meta_cert = load_pem_x509_certificate(meta_cert_src.encode())
+
+                                key_id = meta_cert.fingerprint(hashes.SHA256())[:8]
+                                if key_id == root_cert_key_id:
+                                    root_cert = meta_cert
+                                    break
+                        break
 
     if root_cert:
         now = datetime.utcnow()
@@ -463,28 +596,38 @@ def download_at_certs() -> CertList:
         if sig[2] != digest:
             raise ValueError(f'Invalid hash of AT trust list. expected: {sig[2].hex()}, actual: {digest.hex()}')
 
-        created_at = EPOCH + timedelta(seconds=sig[5]) # I guess? Or "not valid before"?
-        expires_at = EPOCH + timedelta(seconds=sig[4])
+        created_at = datetime.utcfromtimestamp(sig[5]) # I guess? Or "not valid before"?
+        expires_at = datetime.utcfromtimestamp(sig[4])
 
         if now > expires_at:
             raise ValueError(f'AT trust list already expired at {expires_at.isoformat()}')
     else:
         print_err(f'root certificate for AT trust list not found!')
 
-    return load_ehc_certs_cbor(certs_cbor)
+    return load_ehc_certs_cbor(certs_cbor, into)
 
-def download_de_certs() -> CertList:
-    response = requests.get(CERTS_URL_DE, headers={'User-Agent': USER_AGENT})
-    response.raise_for_status()
-    certs_signed_json = response.content
+def download_de_certs(into: Optional[CertList] = None) -> CertList:
+    import requests
+
+    # the trust list and its public key are independent requests, so fetch
+    # them concurrently through one pooled session
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=2) as executor:
+        certs_future  = executor.submit(http_get_cached, CERTS_URL_DE,  {'User-Agent': USER_AGENT}, session)
+        pubkey_future = executor.submit(http_get_cached, PUBKEY_URL_DE, {'User-Agent': USER_AGENT}, session)
+
+        status_code, certs_signed_json = certs_future.result()
+        if status_code < 200 or status_code >= 300:
+            raise ValueError(f'{CERTS_URL_DE} {status_code} {http.client.responses.get(status_code, "")}')
+
+        pubkey: Optional[EllipticCurvePublicKey] = None
+        status_code, pubkey_data = pubkey_future.result()
 
-    pubkey: Optional[EllipticCurvePublicKey] = None
-    response = requests.get(PUBKEY_URL_DE, headers={'User-Agent': USER_AGENT})
-    if response.status_code == 404:
+    if status_code == 404:
         print_err(f'{PUBKEY_URL_DE} root certificate for DE trust list not found (404)!')
+    elif status_code < 200 or status_code >= 300:
+        raise ValueError(f'{PUBKEY_URL_DE} {status_code} {http.client.responses.get(status_code, "")}')
     else:
-        response.raise_for_status()
-        res_pubkey = load_pem_public_key(response.content)
+        res_pubkey = load_pem_public_key(pubkey_data)
 
         if not isinstance(res_pubkey, EllipticCurvePublicKey):
             pubkey_type = type(res_pubkey)
@@ -492,10 +635,12 @@ def download_de_certs() -> CertList:
         else:
             pubkey = res_pubkey
 
-    return load_de_trust_list(certs_signed_json, pubkey)
+    return load_de_trust_list(certs_signed_json, pubkey, into)
 
-def download_sw_certs() -> CertList:
-    certs: CertList = {}
+def download_sw_certs(into: Optional[CertList] = None) -> CertList:
+    import requests
+
+    certs: CertList = into if into is not None else {}
     # TODO: find out how to verify signature?
     response = requests.get(CERTS_URL_SW, headers={'User-Agent': USER_AGENT})
     response.raise_for_status()
@@ -518,8 +663,10 @@ def download_sw_certs() -> CertList:
                     certs[key_id] = cert
     return certs
 
-def download_covid_pass_verifier_certs() -> CertList:
-    certs: CertList = {}
+def download_covid_pass_verifier_certs(into: Optional[CertList] = None) -> CertList:
+    import requests
+
+    certs: CertList = into if into is not None else {}
     response = requests.get(CERTS_URL_UK, headers={'User-Agent': USER_AGENT})
     response.raise_for_status()
     certs_json = json.loads(response.content)
@@ -577,8 +724,10 @@ def download_covid_pass_verifier_certs() -> CertList:
                 print_err(f'decoding covid-pass-verifier.com trust list entry {key_id.hex()} / {b64encode(key_id).decode("ASCII")}: no supported public key data found')
     return certs
 
-def download_fr_certs(token: Optional[str] = None) -> CertList:
-    certs: CertList = {}
+def download_fr_certs(token: Optional[str] = None, into: Optional[CertList] = None) -> CertList:
+    import requests
+
+    certs: CertList = into if into is not None else {}
     if token is None:
         token = os.getenv('FR_TOKEN')
         if token is None:
@@ -619,8 +768,10 @@ def download_fr_certs(token: Optional[str] = None) -> CertList:
 
     return certs
 
-def download_nl_certs(token: Optional[str] = None) -> CertList:
-    certs: CertList = {}
+def download_nl_certs(token: Optional[str] = None, into: Optional[CertList] = None) -> CertList:
+    import requests
+
+    certs: CertList = into if into is not None else {}
     response = requests.get(CERTS_URL_NL, headers={'User-Agent': USER_AGENT})
     response.raise_for_status()
     certs_json = json.loads(response.content)
@@ -647,7 +798,9 @@ def download_nl_certs(token: Optional[str] = None) -> CertList:
                 certs[key_id] = cert
     return certs
 
-def download_ch_certs(token: Optional[str] = None) -> CertList:
+def download_ch_certs(token: Optional[str] = None, into: Optional[CertList] = None) -> CertList:
+    import requests
+
     CH_USER_AGENT = 'ch.admin.bag.covidcertificate.wallet;2.1.1;1626211804080;Android;28'
 
     if token is None:
@@ -685,7 +838,7 @@ def download_ch_certs(token: Optional[str] = None) -> CertList:
     response.raise_for_status()
     pubkeys: List[Dict[str, Optional[str]]] = load_jwt(response.content, root_cert)['certs']
 
-    certs: CertList = {}
+    certs: CertList = into if into is not None else {}
 
     for pub in pubkeys:
         key_id = b64decode(pub['keyId']) # type: ignore
@@ -718,7 +871,9 @@ def download_ch_certs(token: Optional[str] = None) -> CertList:
 
     return certs
 
-def download_no_certs(token: Optional[str] = None) -> CertList:
+def download_no_certs(token: Optional[str] = None, into: Optional[CertList] = None) -> CertList:
+    import requests
+
     NO_USER_AGENT = 'FHICORC/38357 CFNetwork/1240.0.4 Darwin/20.5.0'
 
     if token is None:
@@ -734,7 +889,7 @@ def download_no_certs(token: Optional[str] = None) -> CertList:
     })
     response.raise_for_status()
 
-    certs: CertList = {}
+    certs: CertList = into if into is not None else {}
     # TODO: find out if there is some sort of root cert to verify the trust list?
 
     certs_json = json.loads(response.content)
@@ -748,11 +903,13 @@ def download_no_certs(token: Optional[str] = None) -> CertList:
 
     return certs
 
-def download_uk_certs() -> CertList:
+def download_uk_certs(into: Optional[CertList] = None) -> CertList:
+    import requests
+
     response = requests.get(CERTS_URL_UK, headers={'User-Agent': USER_AGENT})
     response.raise_for_status()
 
-    certs: CertList = {}
+    certs: CertList = into if into is not None else {}
     # TODO: find out if there is some sort of root cert to verify the trust list?
 
     md5_b64 = response.headers.get('content-md5')
@@ -773,7 +930,7 @@ def download_uk_certs() -> CertList:
 
     return certs
 
-DOWNLOADERS: Dict[str, Callable[[], CertList]] = {
+DOWNLOADERS: Dict[str, Callable[..., CertList]] = {
     'AT': download_at_certs,
     'CH': download_ch_certs,
     'DE': download_de_certs,
@@ -787,6 +944,8 @@ DOWNLOADERS: Dict[str, Callable[[], CertList]] = {
 }
 
 def download_ehc_certs(sources: List[str]) -> CertList:
+    # every downloader writes straight into the shared dict, which avoids
+    # re-hashing each source's entries in a certs.update() pass
     certs: CertList = {}
     get_downloader = DOWNLOADERS.get
 
@@ -795,7 +954,7 @@ def download_ehc_certs(sources: List[str]) -> CertList:
         if downloader is None:
             raise ValueError(f'Unknown trust list source: {source}')
 
-        certs.update(downloader())
+        downloader(into=certs)
 
     return certs
 
@@ -875,11 +1034,25 @@ def b64decode_ignore_padding(b64str: str) -> bytes:
 def urlsafe_b64decode_ignore_padding(b64str: str) -> bytes:
     return urlsafe_b64decode(b64str + "=" * ((4 - len(b64str) % 4) % 4))
 
+def scan_qrcode_image(filename: str) -> List[str]:
+    from pyzbar.pyzbar import decode as decode_qrcode # type: ignore
+    from PIL import Image # type: ignore
+
+    image = Image.open(filename, 'r')
+    # let libjpeg decode at a reduced resolution straight to a luminance
+    # plane; the QR finder needs neither full phone-camera resolution nor
+    # chroma (no-op for formats that don't support drafts, like PNG)
+    image.draft('L', (1024, 1024))
+    image.load()
+    qrcodes = decode_qrcode(image)
+    return [qrcode.data.decode('utf-8') for qrcode in qrcodes]
+
+ZLIB_CHUNK_SIZE = 64 * 1024
+
 def decode_ehc(b45_data: str) -> CoseMessage:
-    if b45_data.startswith(PREFIX):
-        b45_data = b45_data[len(PREFIX):]
-    elif b45_data.startswith(PREFIX_NO):
-        b45_data = b45_data[len(PREFIX_NO):]
+    # only one of the prefixes can match, so chaining removeprefix() is safe
+    # and allocates at most one new string
+    b45_data = b45_data.removeprefix(PREFIX).removeprefix(PREFIX_NO)
 
     try:
         data = b45decode(b45_data)
@@ -887,71 +1060,108 @@ def decode_ehc(b45_data: str) -> CoseMessage:
         raise ValueError(f'Invalid base45 string. Try with single quotes.') from None
 
     if data.startswith(b'x'):
-        data = zlib.decompress(data)
+        # decompress in bounded chunks into a single growing buffer and hand
+        # the COSE decoder a memoryview, instead of materializing yet another
+        # full copy of the payload
+        decompressor = zlib.decompressobj()
+        buf = bytearray(decompressor.decompress(data, ZLIB_CHUNK_SIZE))
+        while decompressor.unconsumed_tail:
+            buf += decompressor.decompress(decompressor.unconsumed_tail, ZLIB_CHUNK_SIZE)
+        buf += decompressor.flush()
+        if not decompressor.eof:
+            # zlib.decompress() would have raised here; flush() just returns
+            # whatever partial data it has
+            raise zlib.error('incomplete or truncated input stream')
+        data = memoryview(buf)
 
     msg: CoseMessage = CoseMessage.decode(data)
     return msg
 
-def verify_ehc(msg: CoseMessage, issued_at: datetime, certs: CertList, print_exts: bool = False) -> bool:
-    cose_algo = msg.phdr.get(Algorithm) or msg.uhdr.get(Algorithm)
-    print(f'COSE Sig. Algo.: {cose_algo.fullname if cose_algo is not None else "N/A"}')
-    if isinstance(msg, Sign1Message):
-        print(f'Signature      : {b64encode(msg.signature).decode("ASCII")}')
+# cache of COSE keys built from trust list certificates, so that verifying a
+# batch of EHCs signed by the same DSC only converts the key once
+cose_keys: Dict[bytes, CoseKey] = {}
 
-    given_kid = msg.phdr.get(KID) or msg.uhdr[KID]
-    print(f'Key ID         : {given_kid.hex()} / {b64encode(given_kid).decode("ASCII")}')
+def verify_ehc(msg: CoseMessage, issued_at: datetime, certs: CertList, print_exts: bool = False) -> bool:
+    # gather output lines and write them in as few calls as possible,
+    # instead of a locking/flushing print() call per field; the finally
+    # below makes sure no diagnostics are lost when raising partway through
+    lines: List[str] = []
 
-    cert = certs.get(given_kid) # XXX: is this correct? is it not two levels of signed certificates?
-    if not cert:
-        raise KeyError(f'Key ID not found in trust list: {given_kid.hex()}')
+    def flush_lines() -> None:
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
+            lines.clear()
 
-    pk = cert.public_key()
-    print(f'Key Type       : {type(pk).__name__.strip("_")}')
-    if not isinstance(cert, HackCertificate):
-        print(f'Cert Serial Nr.: {":".join("%02x" % byte for byte in cert.serial_number.to_bytes(20, byteorder="big"))}')
-    print(f'Cert Issuer    : {cert.issuer.rfc4514_string()}')
-    print(f'Cert Subject   : {cert.subject.rfc4514_string()}')
-    print(f'Cert Version   : {cert.version.name}')
-    print( 'Cert Valid In  :',
-        cert.not_valid_before.isoformat() if cert.not_valid_before is not None else 'N/A', '-',
-        cert.not_valid_after.isoformat()  if cert.not_valid_after  is not None else 'N/A')
-
-    cert_expired = False
-    if cert.not_valid_before is not None and issued_at < cert.not_valid_before:
-        cert_expired = True
-
-    if cert.not_valid_after is not None and issued_at > cert.not_valid_after:
-        cert_expired = True
-
-    print(f'Cert Expired   : {cert_expired}')
-    revoked_cert = get_revoked_cert(cert)
-    if revoked_cert:
-        print( 'Cert Revoked At:', revoked_cert.revocation_date.isoformat())
-        revoked = True
-    else:
-        revoked = False
+    try:
+        cose_algo = msg.phdr.get(Algorithm) or msg.uhdr.get(Algorithm)
+        lines.append(f'COSE Sig. Algo.: {cose_algo.fullname if cose_algo is not None else "N/A"}')
+        if isinstance(msg, Sign1Message):
+            lines.append(f'Signature      : {b64encode(msg.signature).decode("ASCII")}')
+
+        given_kid = msg.phdr.get(KID) or msg.uhdr[KID]
+        lines.append(f'Key ID         : {given_kid.hex()} / {b64encode(given_kid).decode("ASCII")}')
+
+        cert = certs.get(given_kid) # XXX: is this correct? is it not two levels of signed certificates?
+        if not cert:
+            raise KeyError(f'Key ID not found in trust list: {given_kid.hex()}')
+
+        pk = cert.public_key()
+        lines.append(f'Key Type       : {type(pk).__name__.strip("_")}')
+        if not isinstance(cert, HackCertificate):
+            lines.append(f'Cert Serial Nr.: {":".join("%02x" % byte for byte in cert.serial_number.to_bytes(20, byteorder="big"))}')
+        lines.append(f'Cert Issuer    : {cert.issuer.rfc4514_string()}')
+        lines.append(f'Cert Subject   : {cert.subject.rfc4514_string()}')
+        lines.append(f'Cert Version   : {cert.version.name}')
+        lines.append('Cert Valid In  : %s - %s' % (
+            cert.not_valid_before.isoformat() if cert.not_valid_before is not None else 'N/A',
+            cert.not_valid_after.isoformat()  if cert.not_valid_after  is not None else 'N/A'))
+
+        cert_expired = False
+        if cert.not_valid_before is not None and issued_at < cert.not_valid_before:
+            cert_expired = True
+
+        if cert.not_valid_after is not None and issued_at > cert.not_valid_after:
+            cert_expired = True
+
+        lines.append(f'Cert Expired   : {cert_expired}')
+
+        # get_revoked_cert() may print_err(); write what we have first so
+        # stdout and stderr stay correctly interleaved
+        flush_lines()
+        revoked_cert = get_revoked_cert(cert)
+        if revoked_cert:
+            lines.append(f'Cert Revoked At: {revoked_cert.revocation_date.isoformat()}')
+            revoked = True
+        else:
+            revoked = False
 
-    if not isinstance(cert, HackCertificate):
-        signature_algorithm_oid = cert.signature_algorithm_oid
-        print(f'Signature Algo.: oid={signature_algorithm_oid.dotted_string}, name={signature_algorithm_oid._name}')
-        print( 'Cert Signature :', b64encode(cert.signature).decode('ASCII'))
+        if not isinstance(cert, HackCertificate):
+            signature_algorithm_oid = cert.signature_algorithm_oid
+            lines.append(f'Signature Algo.: oid={signature_algorithm_oid.dotted_string}, name={signature_algorithm_oid._name}')
+            lines.append(f'Cert Signature : {b64encode(cert.signature).decode("ASCII")}')
 
-    if isinstance(pk, EllipticCurvePublicKey):
-        print(f'Curve          : {pk.curve.name}')
+        if isinstance(pk, EllipticCurvePublicKey):
+            lines.append(f'Curve          : {pk.curve.name}')
 
-    msg.key = cert_to_cose_key(cert)
+        cose_key = cose_keys.get(given_kid)
+        if cose_key is None:
+            cose_key = cert_to_cose_key(cert)
+            cose_keys[given_kid] = cose_key
 
-    valid = msg.verify_signature()
+        msg.key = cose_key
 
-    print(f'Signature Valid: {valid}')
+        valid = msg.verify_signature()
 
-    if print_exts and cert.extensions:
-        print('Extensions     :')
-        for ext in cert.extensions:
-            print(f'- oid={ext.oid.dotted_string}, name={ext.oid._name}, value={ext.value}')
+        lines.append(f'Signature Valid: {valid}')
 
-    return valid and not cert_expired and not revoked
+        if print_exts and cert.extensions:
+            lines.append('Extensions     :')
+            for ext in cert.extensions:
+                lines.append(f'- oid={ext.oid.dotted_string}, name={ext.oid._name}, value={ext.value}')
 
+        return valid and not cert_expired and not revoked
+    finally:
+        flush_lines()
 def cert_to_cose_key(cert: x509.Certificate) -> CoseKey:
     pk = cert.public_key()
     if isinstance(pk, EllipticCurvePublicKey):
@@ -961,8 +1171,8 @@ def cert_to_cose_key(cert: x509.Certificate) -> CoseKey:
         x = ec_pn.x.to_bytes(size, byteorder="big")
         y = ec_pn.y.to_bytes(size, byteorder="big")
 
-        curve_name = CURVE_NAME_IGNORE.sub('', pk.curve.name).lower()
-        curve = COSE_CURVES.get(curve_name)
+        curve_name = pk.curve.name.translate(CURVE_NAME_IGNORE).lower()
+        curve = cose_curves().get(curve_name)
 
         if not curve:
             raise KeyError(f'Unsupported curve: {pk.curve.name}')
@@ -979,8 +1189,10 @@ def cert_to_cose_key(cert: x509.Certificate) -> CoseKey:
         )
     elif isinstance(pk, RSAPublicKey):
         rsa_pn = pk.public_numbers()
-        e = rsa_pn.e.to_bytes((rsa_pn.e.bit_length() + 7) // 8, byteorder='big')
-        n = rsa_pn.n.to_bytes((rsa_pn.n.bit_length() + 7) // 8, byteorder='big')
+        # e is virtually always 65537, which packs into exactly 3 bytes, and
+        # the size of n is already known from the key size
+        e = rsa_pn.e.to_bytes(3 if rsa_pn.e == 65537 else (rsa_pn.e.bit_length() + 7) // 8, byteorder='big')
+        n = rsa_pn.n.to_bytes((pk.key_size + 7) // 8, byteorder='big')
 
         return CoseKey.from_dict(
             {
@@ -1005,6 +1217,8 @@ crl_status: Dict[str, int] = {}
 crls: Dict[str, x509.CertificateRevocationList] = {}
 
 def get_cached_crl(uri: str) -> x509.CertificateRevocationList:
+    import requests
+
     crl = crls.get(uri)
 
     if crl is not None:
@@ -1238,52 +1452,63 @@ def main() -> None:
             for certs_path in args.save_certs:
                 save_certs(certs, certs_path)
 
-        items: List[Tuple[bytes, x509.Certificate]]
+        items: List[Tuple[str, str, bytes, x509.Certificate]]
         revoked_certs: Dict[bytes, x509.RevokedCertificate] = {}
         if args.list_certs or args.strip_revoked:
-            items = list(certs.items())
-            items.sort(key=lambda item: (item[1].issuer.rfc4514_string(), item[1].subject.rfc4514_string(), item[0]))
+            # decorate-sort: build the expensive rfc4514 strings once per
+            # certificate, sort on the plain tuples and reuse the strings in
+            # the listing below (key IDs are unique, so the certificates
+            # themselves are never compared)
+            items = [(cert.issuer.rfc4514_string(), cert.subject.rfc4514_string(), key_id, cert)
+                     for key_id, cert in certs.items()]
+            items.sort()
 
         if args.strip_revoked:
-            for key_id, cert in items:
+            for _, _, key_id, cert in items:
                 revoked_cert = get_revoked_cert(cert)
                 if revoked_cert:
                     revoked_certs[key_id] = revoked_cert
                     revoked = True
 
         if args.list_certs:
-            for key_id, cert in items:
-                print('Key ID          :', key_id.hex(), '/', b64encode(key_id).decode("ASCII"))
+            # gather all output into one buffer and write it in a single
+            # call, instead of thousands of small line-buffered print()s
+            lines: List[str] = []
+            for issuer_str, subject_str, key_id, cert in items:
+                lines.append(f'Key ID          : {key_id.hex()} / {b64encode(key_id).decode("ASCII")}')
                 if not isinstance(cert, HackCertificate):
-                    print('Serial Nr.      :', ":".join("%02x" % byte for byte in cert.serial_number.to_bytes(20, byteorder="big")))
-                print('Issuer          :', cert.issuer.rfc4514_string())
-                print('Subject         :', cert.subject.rfc4514_string())
-                print('Valid Date Range:',
-                    cert.not_valid_before.isoformat() if cert.not_valid_before is not None else 'N/A', '-',
-                    cert.not_valid_after.isoformat()  if cert.not_valid_after  is not None else 'N/A')
-                print('Version         :', cert.version.name)
+                    lines.append(f'Serial Nr.      : {":".join("%02x" % byte for byte in cert.serial_number.to_bytes(20, byteorder="big"))}')
+                lines.append(f'Issuer          : {issuer_str}')
+                lines.append(f'Subject         : {subject_str}')
+                lines.append('Valid Date Range: %s - %s' % (
+                    cert.not_valid_before.isoformat() if cert.not_valid_before is not None else 'N/A',
+                    cert.not_valid_after.isoformat()  if cert.not_valid_after  is not None else 'N/A'))
+                lines.append(f'Version         : {cert.version.name}')
 
                 pk = cert.public_key()
-                print(f'Key Type        : {type(pk).__name__.strip("_")}')
+                lines.append(f'Key Type        : {type(pk).__name__.strip("_")}')
                 if isinstance(pk, EllipticCurvePublicKey):
-                    print( 'Curve           :', pk.curve.name)
+                    lines.append(f'Curve           : {pk.curve.name}')
 
                 if not isinstance(cert, HackCertificate):
                     signature_algorithm_oid = cert.signature_algorithm_oid
-                    print(f'Signature Algo. : oid={signature_algorithm_oid.dotted_string}, name={signature_algorithm_oid._name}')
-                    print( 'Signature       :', b64encode(cert.signature).decode('ASCII'))
+                    lines.append(f'Signature Algo. : oid={signature_algorithm_oid.dotted_string}, name={signature_algorithm_oid._name}')
+                    lines.append(f'Signature       : {b64encode(cert.signature).decode("ASCII")}')
 
                 if args.strip_revoked:
                     revoked_cert = revoked_certs.get(key_id)
                     if revoked_cert:
-                        print('Revoked At      :', revoked_cert.revocation_date.isoformat())
+                        lines.append(f'Revoked At      : {revoked_cert.revocation_date.isoformat()}')
 
                 if args.print_exts and cert.extensions:
-                    print('Extensions      :')
+                    lines.append('Extensions      :')
                     for ext in cert.extensions:
-                        print(f'- oid={ext.oid.dotted_string}, name={ext.oid._name}, value={ext.value}')
+                        lines.append(f'- oid={ext.oid.dotted_string}, name={ext.oid._name}, value={ext.value}')
+
+                lines.append('')
 
-                print()
+            if lines:
+                sys.stdout.write('\n'.join(lines) + '\n')
 
         if args.strip_revoked:
             for key_id in revoked_certs:
@@ -1291,14 +1516,14 @@ def main() -> None:
 
     ehc_codes: List[str] = []
     if args.image:
-        for filename in args.ehc_code:
-            image = Image.open(filename, 'r')
-            qrcodes = decode_qrcode(image)
-            if qrcodes:
-                for qrcode in qrcodes:
-                    ehc_codes.append(qrcode.data.decode("utf-8"))
-            else:
-                print_err(f'{filename}: no qr-code found')
+        # PIL and pyzbar release the GIL in native code, so scanning a batch
+        # of images parallelizes well across threads
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for filename, codes in zip(args.ehc_code, executor.map(scan_qrcode_image, args.ehc_code)):
+                if codes:
+                    ehc_codes.extend(codes)
+                else:
+                    print_err(f'{filename}: no qr-code found')
     else:
         ehc_codes.extend(args.ehc_code)
 
@@ -1309,28 +1534,46 @@ def main() -> None:
         ehc_msg = decode_ehc(ehc_code)
         ehc_payload = cbor2.loads(ehc_msg.payload)
 
+        # grab the claims needed below during the same single pass that
+        # formats them, instead of re-indexing the payload dict afterwards
+        issued_at_int:  Optional[int] = None
+        expires_at_int: Optional[int] = None
+        health_claims:  Optional[Dict[int, Any]] = None
         for key, value in ehc_payload.items():
-            if key != -260:
-                name = CLAIM_NAMES.get(key)
-                if name is not None:
-                    if key in DATETIME_CLAIMS:
-                        dt = EPOCH + timedelta(seconds=value)
-                        value = dt.isoformat()
-                else:
-                    name = f'Claim {key} (unknown)'
-                print(f'{name:15}: {value}')
+            if key == -260:
+                health_claims = value
+                continue
+
+            if key == 6:
+                issued_at_int = value
+            elif key == 4:
+                expires_at_int = value
+
+            name = CLAIM_NAMES.get(key)
+            if name is not None:
+                if key in DATETIME_CLAIMS:
+                    dt = datetime.utcfromtimestamp(value)
+                    value = dt.isoformat()
+            else:
+                name = f'Claim {key} (unknown)'
+            print(f'{name:15}: {value}')
 
-        issued_at = EPOCH + timedelta(seconds=ehc_payload[6])
+        if issued_at_int is None:
+            raise KeyError(6) # Issued At claim is required
+
+        issued_at = datetime.utcfromtimestamp(issued_at_int)
 
-        expires_at_int = ehc_payload.get(4)
         if expires_at_int is not None:
-            expires_at = EPOCH + timedelta(seconds=expires_at_int)
+            expires_at = datetime.utcfromtimestamp(expires_at_int)
             print(f'Is Expired     :', datetime.utcnow() > expires_at)
 
         if certs is not None:
             verify_ehc(ehc_msg, issued_at, certs, args.print_exts)
 
-        ehc = ehc_payload[-260][1]
+        if health_claims is None:
+            raise KeyError(-260) # Health Claims claim is required
+
+        ehc = health_claims[1]
 
         print('Payload        :')
         print(json.dumps(ehc, indent=4, sort_keys=True, default=json_serial))